@@ -5,6 +5,8 @@
 #
 # Author: Luca Colagrande <colluca@iis.ee.ethz.ch>
 
+import io
+import numpy as np
 import sys
 
 import snitch.util.sim.data_utils as du
@@ -17,10 +19,24 @@ class AxpyDataGen(du.DataGen):
     BURST_ALIGNMENT = 4096
     # Function pointers to alternative implementations
     FUNCPTRS = ["axpy_naive", "axpy_fma", "axpy_opt"]
+    # Data is generated deterministically, so it can be cached
+    SEED = 42
+    CACHEABLE = True
 
     def golden_model(self, a, x, y):
         return a*x + y
 
+    def golden_model_chunks(self, a, x, y):
+        # Evaluates the golden model in chunks, reusing a single buffer,
+        # to avoid materializing the full result
+        buf = np.empty(min(len(x), du.STREAM_CHUNK_SIZE))
+        for start in range(0, len(x), du.STREAM_CHUNK_SIZE):
+            end = min(start + du.STREAM_CHUNK_SIZE, len(x))
+            chunk = buf[:end - start]
+            np.multiply(x[start:end], a, out=chunk)
+            np.add(chunk, y[start:end], out=chunk)
+            yield chunk
+
     def validate(self, **kwargs):
         assert kwargs['n'] % kwargs['n_tiles'] == 0, "n must be an integer multiple of n_tiles"
         n_per_tile = kwargs['n'] // kwargs['n_tiles']
@@ -34,14 +50,17 @@ class AxpyDataGen(du.DataGen):
         du.validate_tcdm_footprint(total_size)
 
     def emit_header(self, **kwargs):
-        header = [super().emit_header()]
+        f = io.StringIO()
+        self.write_header(f, **kwargs)
+        return f.getvalue()
 
+    def write_header(self, f, **kwargs):
         self.validate(**kwargs)
 
-        a = du.generate_random_array(1)[0]
-        x = du.generate_random_array(kwargs['n'])
-        y = du.generate_random_array(kwargs['n'])
-        g = self.golden_model(a, x, y)
+        rng = np.random.default_rng(self.SEED)
+        a = du.generate_random_array(1, seed=rng)[0]
+        x = du.generate_random_array(kwargs['n'], seed=rng)
+        y = du.generate_random_array(kwargs['n'], seed=rng)
 
         x_uid = 'x'
         y_uid = 'y'
@@ -57,19 +76,28 @@ class AxpyDataGen(du.DataGen):
             'funcptr': kwargs['funcptr']
         }
 
-        header += [du.format_scalar_definition('const double', 'a', a)]
-        header += [du.format_array_definition('double', x_uid, x,
-                   alignment=self.BURST_ALIGNMENT, section=kwargs['section'])]
-        header += [du.format_array_definition('double', y_uid, y,
-                   alignment=self.BURST_ALIGNMENT, section=kwargs['section'])]
-        header += [du.format_array_declaration('double', z_uid, x.shape,
-                   alignment=self.BURST_ALIGNMENT, section=kwargs['section'])]
-        header += [du.format_struct_definition('axpy_args_t', 'args', cfg)]
-        result_def = du.format_array_definition('double', 'g', g)
-        header += [du.format_ifdef_wrapper('BIST', result_def)]
-        header = '\n\n'.join(header)
-
-        return header
+        f.write(super().emit_header())
+        f.write('\n\n')
+        f.write(du.format_scalar_definition('const double', 'a', a))
+        f.write('\n\n')
+        du.emit_array_definition_stream(f, 'double', x_uid, x,
+                                        alignment=self.BURST_ALIGNMENT,
+                                        section=kwargs['section'], hex_floats=True)
+        f.write('\n\n')
+        du.emit_array_definition_stream(f, 'double', y_uid, y,
+                                        alignment=self.BURST_ALIGNMENT,
+                                        section=kwargs['section'], hex_floats=True)
+        f.write('\n\n')
+        f.write(du.format_array_declaration('double', z_uid, x.shape,
+                alignment=self.BURST_ALIGNMENT, section=kwargs['section']))
+        f.write('\n\n')
+        f.write(du.format_struct_definition('axpy_args_t', 'args', cfg))
+        f.write('\n\n')
+        f.write('#ifdef BIST\n')
+        du.emit_chunked_array_definition_stream(f, 'double', 'g', x.shape,
+                                                self.golden_model_chunks(a, x, y),
+                                                hex_floats=True)
+        f.write('\n#endif // BIST\n')
 
 
 if __name__ == '__main__':
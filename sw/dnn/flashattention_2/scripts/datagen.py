@@ -7,19 +7,21 @@
 # Luca Colagrande <colluca@iis.ee.ethz.ch>
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+import io
+import math
+import multiprocessing
 import numpy as np
+import os
 import pathlib
-import json5
-import torch
 import pyflexfloat as ff
 
 from snitch.util.sim import data_utils
 from snitch.util.sim.data_utils import format_struct_definition, \
-    format_array_definition, format_array_declaration, emit_license
-from snitch.blas import gemm
+    format_array_declaration, emit_array_definition_stream, emit_license
 
-np.random.seed(42)
-torch.manual_seed(42)
+RNG = np.random.default_rng(42)
 
 # AXI splits bursts crossing 4KB address boundaries. To minimize
 # the occurrence of these splits the data should be aligned to 4KB
@@ -27,65 +29,145 @@ BURST_ALIGNMENT = 4096
 
 
 def torch_golden_model(Q, K, V):
+    # Imported lazily, as importing PyTorch is slow and it is only needed here
+    import torch
     return torch.nn.functional.scaled_dot_product_attention(Q, K, V)
 
 
-def exact_golden_model(Q, K, V, B_r, B_c):
-    # Convert torch tensors to numpy arrays
-    Q = Q.numpy()
-    K = K.numpy()
-    V = V.numpy()
+def exact_golden_model(Q, K, V, B_r, B_c, tiled=False):
+    # Convert torch tensors to numpy arrays. The model is evaluated in the
+    # precision of the inputs, but at least in FP32 for numerical safety,
+    # as in the kernel
+    dtype = np.promote_types(Q.numpy().dtype, np.float32)
+    Q = Q.numpy().astype(dtype, copy=False)
+    K = K.numpy().astype(dtype, copy=False)
+    V = V.numpy().astype(dtype, copy=False)
+    # The tiled model replicates the online softmax computation performed
+    # by the kernel, and is only required for bitwise verification thereof
+    if tiled:
+        return tiled_golden_model(Q, K, V, B_r, B_c)
     # Get layer dimensions
     L = Q.shape[0]
-    S = K.shape[0]
+    d = Q.shape[1]
     # Calculate tiling parameters
     T_r = L // B_r
-    T_c = S // B_c
-    # Transpose K
-    K_t = np.transpose(K)
-    # Iterate tiles
-    O_tiles = []
+    # numexpr is optional, and only used to accelerate the exponential
+    try:
+        import numexpr
+    except ImportError:
+        numexpr = None
+    # Iterate row blocks, computing the softmax over the full row at once
+    output = np.empty((L, d), dtype=Q.dtype)
     for i in range(T_r):
         # Tile Q
         start_row = i * B_r
         end_row = start_row + B_r
         Q_i = Q[start_row:end_row, :]
-        # Initialize l_i, m_i, O_i
-        m_i = np.full((B_r, 1), -np.inf)
-        for j in range(T_c):
-            # Tile K_t and V
-            start_col = j * B_c
-            end_col = start_col + B_c
-            K_t_j = K_t[:, start_col:end_col]
-            V_j = V[start_col:end_col, ]
-            # Compute O tile update
-            S_ij = np.matmul(Q_i, K_t_j)
-            m_i_prev = m_i
-            m_i = np.maximum(m_i_prev, np.max(S_ij, 1, keepdims=True))
-            shifted_exp = np.exp(m_i_prev - m_i)
-            P_ij = np.exp(S_ij - m_i)
-            PxV = np.matmul(P_ij, V_j)
-            if j == 0:
-                l_i = np.sum(P_ij, 1, keepdims=True)
-                O_i = PxV
-            else:
-                l_i = (shifted_exp * l_i) + np.sum(P_ij, 1, keepdims=True)
-                diag = np.diag(shifted_exp[:, 0])
-                diag_inv = np.linalg.inv(diag)
-                O_i = np.matmul(diag_inv, O_i)
-                O_i += PxV
-        # Finalize O tile
-        diag_l_i = np.diag(l_i[:, 0])
-        diag_l_inv_i = np.linalg.inv(diag_l_i)
-        O_i = np.matmul(diag_l_inv_i, O_i)
-        O_tiles.append(O_i)
-    return np.concatenate(O_tiles, 0)
+        # Compute O tile. K is kept in row-major layout and transposed
+        # through a (zero-copy) view, which BLAS consumes directly
+        S_i = np.matmul(Q_i, K.T)
+        m_i = np.max(S_i, 1, keepdims=True)
+        # The (B_r, S) elementwise exponential is memory-bound, numexpr
+        # evaluates it in cache-sized blocks over multiple threads
+        if numexpr is not None:
+            P_i = numexpr.evaluate('exp(S_i - m_i)')
+        else:
+            P_i = np.exp(S_i - m_i)
+        l_i = np.sum(P_i, 1, keepdims=True)
+        output[start_row:end_row, :] = np.matmul(P_i, V) / l_i
+    return output
+
+
+def _tiled_golden_row_block(Q_i, K, V, B_c):
+    # Get layer dimensions
+    S = K.shape[0]
+    # Calculate tiling parameters
+    T_c = S // B_c
+    # Initialize l_i, m_i, O_i from the first tile, so that the
+    # remaining iterations need not special-case it
+    K_j = K[:B_c, :]
+    V_j = V[:B_c, ]
+    S_ij = np.matmul(Q_i, K_j.T)
+    m_i = np.max(S_ij, 1, keepdims=True)
+    P_ij = np.exp(S_ij - m_i)
+    l_i = np.sum(P_ij, 1, keepdims=True)
+    O_i = np.matmul(P_ij, V_j)
+    for j in range(1, T_c):
+        # Tile K and V
+        start_col = j * B_c
+        end_col = start_col + B_c
+        K_j = K[start_col:end_col, :]
+        V_j = V[start_col:end_col, ]
+        # Compute O tile update. K_j is contiguous, and transposed through
+        # a (zero-copy) view, which BLAS consumes directly
+        S_ij = np.matmul(Q_i, K_j.T)
+        m_i_prev = m_i
+        m_i = np.maximum(m_i_prev, np.max(S_ij, 1, keepdims=True))
+        # A single exponential per row rescales both l_i and O_i
+        shifted_exp = np.exp(m_i_prev - m_i)
+        # P_ij is computed in place of S_ij, which is no longer needed
+        P_ij = np.exp(np.subtract(S_ij, m_i, out=S_ij), out=S_ij)
+        l_i = (shifted_exp * l_i) + np.sum(P_ij, 1, keepdims=True)
+        # diag(shifted_exp)^-1 * O_i, as a row-wise broadcast, in place
+        O_i /= shifted_exp
+        O_i += np.matmul(P_ij, V_j)
+    # Finalize O tile: diag(l_i)^-1 * O_i
+    return O_i / l_i
+
+
+# Arguments shared by all row blocks, set once per worker process by
+# _init_golden_model_worker() to avoid transferring them for every task
+_worker_args = None
+
+
+def _init_golden_model_worker(K, V, B_c):
+    global _worker_args
+    _worker_args = (K, V, B_c)
+    # The per-tile matmuls are too small to benefit from multithreaded BLAS,
+    # parallelism is exploited across row blocks instead. threadpoolctl is
+    # optional, and only used to this end
+    try:
+        import threadpoolctl
+    except ImportError:
+        return
+    threadpoolctl.threadpool_limits(1)
+
+
+def _tiled_golden_worker_row_block(Q_i):
+    return _tiled_golden_row_block(Q_i, *_worker_args)
+
+
+def tiled_golden_model(Q, K, V, B_r, B_c):
+    # Get layer dimensions
+    L = Q.shape[0]
+    # Calculate tiling parameters
+    T_r = L // B_r
+    # Tile Q
+    Q_tiles = [Q[i * B_r:(i + 1) * B_r, :] for i in range(T_r)]
+    # A single row block doesn't justify the overhead of a process pool
+    if T_r == 1:
+        return _tiled_golden_row_block(Q_tiles[0], K, V, B_c)
+    # Row blocks are independent, so we process them in parallel. Each
+    # worker receives K and V only once, and a contiguous batch of Q tiles.
+    # Workers are spawned rather than forked, as forking a process whose
+    # BLAS or OpenMP thread pools are already running can deadlock
+    max_workers = min(T_r, os.cpu_count() or 1)
+    chunksize = math.ceil(T_r / max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_golden_model_worker,
+                             initargs=(K, V, B_c)) as executor:
+        O_tiles = executor.map(_tiled_golden_worker_row_block, Q_tiles, chunksize=chunksize)
+        return np.concatenate(list(O_tiles), 0)
 
 
 np.set_printoptions(formatter={'object': str})
 
 
 def exact_flexfloat_golden_model(Q, K, V, B_r, B_c, desc):
+    # Imported lazily, as only the flexfloat model and validation need it
+    from snitch.blas.gemm import GemmDataGen
+    gemm = GemmDataGen()
     # Get layer dimensions
     L = Q.shape[0]
     d = Q.shape[1]
@@ -112,13 +194,13 @@ def exact_flexfloat_golden_model(Q, K, V, B_r, B_c, desc):
             V_j = V[start_col:end_col,]
             # Compute O tile update
             S_ij = ff.array(np.zeros((B_r, B_c)), desc)
-            S_ij = gemm.GemmDataGen().exact_golden_model(1, Q_i, K_t_j, 0, S_ij)
+            S_ij = gemm.exact_golden_model(1, Q_i, K_t_j, 0, S_ij)
             m_i_prev = m_i
             m_i = np.maximum(m_i_prev, np.max(S_ij, 1, keepdims=True))
             shifted_exp = np.exp((m_i_prev.astype(np.float32) - m_i.astype(np.float32)))
             P_ij = np.exp((S_ij - m_i).astype(np.float32))
             PxV = ff.array(np.zeros((B_r, d)), desc)
-            PxV = gemm.GemmDataGen().exact_golden_model(1, P_ij, V_j, 0, PxV)
+            PxV = gemm.exact_golden_model(1, P_ij, V_j, 0, PxV)
             row_sum = np.sum(P_ij.astype(np.float32), 1, keepdims=True)
             if j == 0:
                 l_i = row_sum
@@ -137,6 +219,11 @@ def exact_flexfloat_golden_model(Q, K, V, B_r, B_c, desc):
     return np.concatenate(O_tiles, 0)
 
 
+def validate_gemm(**kwargs):
+    from snitch.blas.gemm import GemmDataGen
+    GemmDataGen().validate(**kwargs)
+
+
 # Verify layer parameters are valid
 def validate(L, S, d, B_r, B_c, dtype, baseline, gemm_impl):
     assert (L % B_r) == 0, 'L is not an integer multiple of B_r'
@@ -164,23 +251,12 @@ def validate(L, S, d, B_r, B_c, dtype, baseline, gemm_impl):
     data_utils.validate_tcdm_footprint(total_size)
 
     # Q*K^t
-    gemm.GemmDataGen().validate(
-        gemm_fp=gemm_impl, parallelize_m=0, parallelize_k=0, m_tiles=1, n_tiles=1,
-        k_tiles=1, transa=0, transb=1, M=B_r, N=B_c, K=d, beta=0
-    )
+    gemm_args = {'gemm_fp': gemm_impl, 'parallelize_m': 0, 'parallelize_k': 0, 'm_tiles': 1,
+                 'n_tiles': 1, 'k_tiles': 1, 'transa': 0}
+    validate_gemm(**gemm_args, transb=1, M=B_r, N=B_c, K=d, beta=0)
 
-    # P*V
-    if baseline:
-        gemm.GemmDataGen().validate(
-            gemm_fp=gemm_impl, parallelize_m=0, parallelize_k=0, m_tiles=1, n_tiles=1,
-            k_tiles=1, transa=0, transb=0, M=B_r, N=d, K=B_c, beta=1
-        )
-    else:
-        # P*(V^t)^t
-        gemm.GemmDataGen().validate(
-            gemm_fp=gemm_impl, parallelize_m=0, parallelize_k=0, m_tiles=1, n_tiles=1,
-            k_tiles=1, transa=0, transb=1, M=B_r, N=d, K=B_c, beta=1
-        )
+    # P*V if baseline, P*(V^t)^t otherwise
+    validate_gemm(**gemm_args, transb=0 if baseline else 1, M=B_r, N=d, K=B_c, beta=1)
 
 
 def get_gemm_implementation(params):
@@ -195,7 +271,7 @@ def get_gemm_implementation(params):
     return impl
 
 
-def emit_header(section, params):
+def write_header(f, section, params):
     L = params['L']
     S = params['S']
     d = params['d']
@@ -206,18 +282,14 @@ def emit_header(section, params):
 
     validate(gemm_impl=gemm_impl, **params)
 
-    # torch_type = data_utils.torch_type_from_precision_t(prec)
     ff_desc = data_utils.ff_desc_from_precision_t(prec)
     ctype = data_utils.ctype_from_precision_t(prec)
 
     # Generate same data for all dtypes for easier debugging.
-    # To achieve this, we always generate in FP16 and then convert.
-    # Q = torch.rand(L, d, requires_grad=False, dtype=torch.float16).to(dtype=torch_type)
-    # K = torch.rand(S, d, requires_grad=False, dtype=torch.float16).to(dtype=torch_type)
-    # V = torch.rand(S, d, requires_grad=False, dtype=torch.float16).to(dtype=torch_type)
-    Q = ff.array(np.random.rand(L, d), ff_desc)
-    K = ff.array(np.random.rand(S, d), ff_desc)
-    V = ff.array(np.random.rand(S, d), ff_desc)
+    # To achieve this, we always generate in FP64 and then convert.
+    Q = ff.array(RNG.random((L, d)), ff_desc)
+    K = ff.array(RNG.random((S, d)), ff_desc)
+    V = ff.array(RNG.random((S, d)), ff_desc)
 
     output = exact_flexfloat_golden_model(Q, K, V, B_r, B_c, ff_desc)
 
@@ -235,21 +307,33 @@ def emit_header(section, params):
         'O': o_uid,
     }
 
-    data_str = [emit_license()]
-    data_str += [format_array_declaration(ctype, q_uid, Q.shape)]
-    data_str += [format_array_declaration(ctype, k_uid, K.shape)]
-    data_str += [format_array_declaration(ctype, v_uid, V.shape)]
-    data_str += [format_array_declaration(ctype, o_uid, output.shape)]
-    data_str += [format_struct_definition('flashattention_2_layer_t', 'layer', layer_cfg)]
-    data_str += [format_array_definition(ctype, q_uid, Q)]
-    data_str += [format_array_definition(ctype, k_uid, K)]
-    data_str += [format_array_definition(ctype, v_uid, V)]
-    data_str = '\n\n'.join(data_str)
+    f.write(emit_license())
+    f.write('\n\n')
+    f.write(format_array_declaration(ctype, q_uid, Q.shape))
+    f.write('\n\n')
+    f.write(format_array_declaration(ctype, k_uid, K.shape))
+    f.write('\n\n')
+    f.write(format_array_declaration(ctype, v_uid, V.shape))
+    f.write('\n\n')
+    f.write(format_array_declaration(ctype, o_uid, output.shape))
+    f.write('\n\n')
+    f.write(format_struct_definition('flashattention_2_layer_t', 'layer', layer_cfg))
+    f.write('\n\n')
+    emit_array_definition_stream(f, ctype, q_uid, Q, hex_floats=True)
+    f.write('\n\n')
+    emit_array_definition_stream(f, ctype, k_uid, K, hex_floats=True)
+    f.write('\n\n')
+    emit_array_definition_stream(f, ctype, v_uid, V, hex_floats=True)
+
 
-    return data_str
+def emit_header(section, params):
+    f = io.StringIO()
+    write_header(f, section, params)
+    return f.getvalue()
 
 
 def main():
+    import json5
 
     parser = argparse.ArgumentParser(description='Generate data for layernorm kernel')
     parser.add_argument(
@@ -262,6 +346,11 @@ def main():
         '--section',
         type=str,
         help='Section to store matrices in')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f'Do not use the data generation cache, even if '
+             f'{data_utils.DATAGEN_CACHE_ENV_VAR} is set')
     parser.add_argument(
         'output',
         type=pathlib.Path,
@@ -272,9 +361,18 @@ def main():
     with args.cfg.open() as f:
         param = json5.loads(f.read())
 
+    # The header also depends on the GEMM data generator, used for
+    # validation and in the flexfloat golden model
+    from snitch.blas.gemm import GemmDataGen
+
     # Emit header file
-    with open(args.output, 'w') as f:
-        f.write(emit_header(args.section, param))
+    if args.no_cache:
+        with data_utils.MmapWriter(args.output) as f:
+            write_header(f, args.section, param)
+    else:
+        data_utils.cached_emit(args.output, {'section': args.section, **param},
+                               lambda f: write_header(f, args.section, param),
+                               sources=[__file__, inspect.getfile(GemmDataGen)])
 
 
 if __name__ == '__main__':
@@ -7,15 +7,15 @@
 # Viviane Potocnik <vivianep@iis.ee.ethz.ch>
 # Luca Colagrande <colluca@iis.ee.ethz.ch>
 
+import io
 import numpy as np
 import pyflexfloat as ff
 import sys
 
 from snitch.util.sim.data_utils import ctype_from_precision_t, ff_desc_from_precision_t, \
-    format_struct_definition, format_array_definition, format_array_declaration, \
-    format_ifdef_wrapper, DataGen
+    format_struct_definition, format_array_declaration, emit_array_definition_stream, DataGen
 
-np.random.seed(42)
+RNG = np.random.default_rng(42)
 
 # AXI splits bursts crossing 4KB address boundaries. To minimize
 # the occurrence of these splits the data should be aligned to 4KB
@@ -28,15 +28,18 @@ class TransposeDataGen(DataGen):
         return np.transpose(inp)
 
     def emit_header(self, **kwargs):
-        header = [super().emit_header()]
+        f = io.StringIO()
+        self.write_header(f, **kwargs)
+        return f.getvalue()
 
+    def write_header(self, f, **kwargs):
         M, N, prec = kwargs['M'], kwargs['N'], kwargs['prec']
         assert (M % 8) == 0, "M must be an integer multiple of the number of cores"
 
         ff_desc = ff_desc_from_precision_t(prec)
         ctype = ctype_from_precision_t(prec)
 
-        inp = ff.array(np.random.rand(M, N), ff_desc)
+        inp = ff.array(RNG.random((M, N)), ff_desc)
         output = self.golden_model(inp)
 
         input_uid = 'input'
@@ -50,17 +53,23 @@ class TransposeDataGen(DataGen):
             'baseline': kwargs['baseline']
         }
 
-        header += [format_array_declaration(ctype, input_uid, inp.shape,
-                                            alignment=BURST_ALIGNMENT)]
-        header += [format_array_declaration(ctype, output_uid, output.shape,
-                                            alignment=BURST_ALIGNMENT)]
-        header += [format_struct_definition('transpose_layer_t', 'layer', layer_cfg)]
-        header += [format_array_definition(ctype, input_uid, inp, alignment=BURST_ALIGNMENT)]
-        result_def = format_array_definition(ctype, 'golden', output, alignment=BURST_ALIGNMENT)
-        header += [format_ifdef_wrapper('BIST', result_def)]
-        header = '\n\n'.join(header)
-
-        return header
+        f.write(super().emit_header())
+        f.write('\n\n')
+        f.write(format_array_declaration(ctype, input_uid, inp.shape,
+                                         alignment=BURST_ALIGNMENT))
+        f.write('\n\n')
+        f.write(format_array_declaration(ctype, output_uid, output.shape,
+                                         alignment=BURST_ALIGNMENT))
+        f.write('\n\n')
+        f.write(format_struct_definition('transpose_layer_t', 'layer', layer_cfg))
+        f.write('\n\n')
+        emit_array_definition_stream(f, ctype, input_uid, inp, alignment=BURST_ALIGNMENT,
+                                     hex_floats=True)
+        f.write('\n\n')
+        f.write('#ifdef BIST\n')
+        emit_array_definition_stream(f, ctype, 'golden', output, alignment=BURST_ALIGNMENT,
+                                     hex_floats=True)
+        f.write('\n#endif // BIST\n')
 
 
 if __name__ == '__main__':
@@ -7,11 +7,18 @@
 
 
 import argparse
-import json5
+import functools
+import hashlib
+import inspect
+import io
+import json
+import mmap
+import os
 import pathlib
+import shutil
 import struct
+import sys
 from datetime import datetime
-import torch
 import numpy as np
 import pyflexfloat as ff
 import humanize
@@ -19,6 +26,12 @@ import humanize
 # Maximum available size in TCDM (in bytes)
 TCDM_HEAP_SIZE = 112 * 1024
 
+# Number of array elements formatted per write when streaming arrays to a file
+STREAM_CHUNK_SIZE = 4096
+
+# Environment variable pointing to the directory used to cache generated data
+DATAGEN_CACHE_ENV_VAR = 'SNITCH_DATAGEN_CACHE'
+
 
 def emit_license():
     """Emit license header.
@@ -74,6 +87,9 @@ def torch_type_from_precision_t(prec):
         prec: A value of type `precision_t`. Accepts both enum strings
             (e.g. "FP64") and integer enumeration values (e.g. 8).
     """
+    # Imported lazily, as importing PyTorch is slow and most scripts don't need it
+    import torch
+
     precision_t_to_torch_type_map = {
         8: torch.float64,
         4: torch.float32,
@@ -131,6 +147,8 @@ def generate_random_array(size, prec='FP64', seed=None):
         size: Tuple of array dimensions.
         prec: A value of type `precision_t`. Accepts both enum strings
             (e.g. "FP64") and integer enumeration values (e.g. 8).
+        seed: Seed, or Numpy `Generator` instance, passed on to
+            `np.random.default_rng()`.
     """
     # Generate in 64b precision and then cast down
     rand = np.random.default_rng(seed=seed).random(size=size, dtype=np.float64) * 2 - 1
@@ -147,9 +165,11 @@ def flatten(array):
     Args:
         array: Can be a Numpy array, a PyTorch tensor or a nested list.
     """
+    # If PyTorch was never imported, the array can't be a PyTorch tensor
+    torch = sys.modules.get('torch')
     if isinstance(array, np.ndarray):
         return array.flatten()
-    elif isinstance(array, torch.Tensor):
+    elif torch is not None and isinstance(array, torch.Tensor):
         return array.numpy().flatten()
     elif isinstance(array, list):
         return np.array(array).flatten()
@@ -176,55 +196,159 @@ def _alias_dtype(dtype):
         return dtype
 
 
-def format_array_declaration(dtype, uid, shape, alignment=None, section=None):
+# Declarations only vary in a small set of type and attribute combinations,
+# so their invariant parts are generated once per combination
+@functools.lru_cache(maxsize=None)
+def _declaration_affixes(dtype, alignment=None, section=None):
     attributes = _variable_attributes(alignment, section)
-    s = f'{_alias_dtype(dtype)} {uid}'
-    for dim in shape:
-        s += f'[{dim}]'
-    if attributes:
-        s += f' {attributes};'
-    else:
-        s += ';'
-    return s
+    prefix = f'{_alias_dtype(dtype)} '
+    suffix = f' {attributes};' if attributes else ';'
+    return prefix, suffix
+
+
+def format_array_declaration(dtype, uid, shape, alignment=None, section=None):
+    prefix, suffix = _declaration_affixes(dtype, alignment, section)
+    dims = ''.join(f'[{dim}]' for dim in shape)
+    return f'{prefix}{uid}{dims}{suffix}'
 
 
 # In the case of dtype __fp8, array field expects a dictionary of
 # sign, exponent and mantissa arrays
-def format_array_definition(dtype, uid, array, alignment=None, section=None):
+def format_array_definition(dtype, uid, array, alignment=None, section=None, hex_floats=False):
     # Definition starts with the declaration stripped off of the terminating semicolon
     s = format_array_declaration(dtype, uid, array.shape, alignment, section)[:-1]
     s += ' = '
-    s += format_array_initializer(dtype, array)
+    s += format_array_initializer(dtype, array, hex_floats)
     s += ';'
     return s
 
 
 def format_scalar_definition(dtype, uid, scalar):
-    s = f'{_alias_dtype(dtype)} {uid} = {scalar};'
-    return s
+    prefix, _ = _declaration_affixes(dtype)
+    return f'{prefix}{uid} = {scalar};'
 
 
 def format_scalar_declaration(dtype, uid, alignment=None, section=None):
-    attributes = _variable_attributes(alignment, section)
-    s = f'{_alias_dtype(dtype)} {uid}'
-    if attributes:
-        s += f' {attributes};'
+    prefix, suffix = _declaration_affixes(dtype, alignment, section)
+    return f'{prefix}{uid}{suffix}'
+
+
+def format_array_initializer(dtype, array, hex_floats=False):
+    f = io.StringIO()
+    emit_array_initializer_stream(f, dtype, array, hex_floats)
+    return f.getvalue()
+
+
+def _format_array_element(dtype, el, hex_floats=False):
+    if dtype == '__fp8':
+        return f'\t{hex(el.bits())},\n'
+    elif hex_floats:
+        return f'\t{float(el).hex()},\n'
     else:
-        s += ';'
-    return s
+        return f'\t{el},\n'
 
 
-def format_array_initializer(dtype, array):
-    s = '{\n'
-    array = flatten(array)
-    for el in array:
-        if dtype == '__fp8':
-            el_str = f'{hex(el.bits())}'
-        else:
-            el_str = f'{el}'
-        s += f'\t{el_str},\n'
-    s += '}'
-    return s
+def iter_array_chunks(array, chunk_size=STREAM_CHUNK_SIZE):
+    """Iterate over a flattened array in chunks.
+
+    Args:
+        array: The array to iterate over. Accepts any type supported by
+            `flatten()`.
+        chunk_size: Number of elements per chunk. The last chunk may be
+            shorter.
+
+    Yields:
+        Consecutive 1D slices of the flattened array.
+    """
+    # Unlike `flatten()`, avoid copying arrays which are already contiguous
+    if isinstance(array, np.ndarray):
+        array = np.ravel(array)
+    else:
+        array = flatten(array)
+    for start in range(0, len(array), chunk_size):
+        yield array[start:start + chunk_size]
+
+
+def _format_array_chunk(dtype, chunk, hex_floats):
+    # Fast path for native floating-point arrays: tolist() converts all
+    # elements to Python floats in one go, which can be formatted directly
+    if hex_floats and isinstance(chunk, np.ndarray) and chunk.dtype.kind == 'f' and len(chunk):
+        return '\t' + ',\n\t'.join(map(float.hex, chunk.tolist())) + ',\n'
+    return ''.join(_format_array_element(dtype, el, hex_floats) for el in chunk)
+
+
+def _emit_initializer_chunks(f, dtype, chunks, hex_floats):
+    f.write('{\n')
+    for chunk in chunks:
+        f.write(_format_array_chunk(dtype, chunk, hex_floats))
+    f.write('}')
+
+
+def emit_array_initializer_stream(f, dtype, array, hex_floats=False):
+    """Write an array initializer to a file.
+
+    Equivalent to `format_array_initializer()`, but the elements are
+    formatted and written in chunks of `STREAM_CHUNK_SIZE`, so that the
+    whole initializer never needs to be held in memory.
+
+    Args:
+        f: A file-like object open for writing in text mode.
+        dtype: The C type of the array elements.
+        array: The array to write.
+        hex_floats: If True, floating-point elements are formatted as
+            C99 hexadecimal floating-point literals (e.g. `0x1.8p+1`).
+            These represent the exact element values and are cheaper to
+            generate than the shortest round-tripping decimal literals,
+            at the expense of readability.
+    """
+    _emit_initializer_chunks(f, dtype, iter_array_chunks(array), hex_floats)
+
+
+def emit_array_definition_stream(f, dtype, uid, array, alignment=None, section=None,
+                                 hex_floats=False):
+    """Write an array definition to a file.
+
+    Streaming equivalent of `format_array_definition()`, see
+    `emit_array_initializer_stream()`.
+
+    Args:
+        f: A file-like object open for writing in text mode.
+        dtype: The C type of the array elements.
+        uid: The name of the array variable.
+        array: The array to write.
+        alignment: Optional alignment attribute of the variable.
+        section: Optional section attribute of the variable.
+        hex_floats: See `emit_array_initializer_stream()`.
+    """
+    emit_chunked_array_definition_stream(f, dtype, uid, array.shape, iter_array_chunks(array),
+                                         alignment, section, hex_floats)
+
+
+def emit_chunked_array_definition_stream(f, dtype, uid, shape, chunks, alignment=None,
+                                         section=None, hex_floats=False):
+    """Write an array definition to a file, from an iterable of chunks.
+
+    Like `emit_array_definition_stream()`, but the array elements are
+    provided as an iterable of 1D chunks, in row-major order. The chunks
+    can thus be computed on the fly, e.g. by a generator, without ever
+    materializing the whole array.
+
+    Args:
+        f: A file-like object open for writing in text mode.
+        dtype: The C type of the array elements.
+        uid: The name of the array variable.
+        shape: The shape of the array.
+        chunks: An iterable of 1D arrays, which concatenated form the
+            flattened array.
+        alignment: Optional alignment attribute of the variable.
+        section: Optional section attribute of the variable.
+        hex_floats: See `emit_array_initializer_stream()`.
+    """
+    # Definition starts with the declaration stripped off of the terminating semicolon
+    f.write(format_array_declaration(dtype, uid, shape, alignment, section)[:-1])
+    f.write(' = ')
+    _emit_initializer_chunks(f, dtype, chunks, hex_floats)
+    f.write(';')
 
 
 def format_struct_definition(dtype, uid, map):
@@ -292,13 +416,130 @@ def from_buffer(byte_array, ctype='uint32_t'):
         return ff.frombuffer(byte_array, 'e5m2')
 
 
+class MmapWriter:
+    """Text file writer backed by a memory-mapped file.
+
+    The output file is pre-sized and memory-mapped, so that written
+    strings are copied directly into the page cache, bypassing the
+    buffered I/O layer. The file and its mapping grow geometrically as
+    data is written, and the file is truncated to the actual size of the
+    written data when the writer is closed.
+
+    Can be used as a context manager, like the file objects returned by
+    `open()`, and is a drop-in replacement for these in all `emit_*()`
+    functions.
+
+    Args:
+        path: Path of the file to write.
+    """
+
+    INITIAL_CAPACITY = 1024 * 1024
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        self._pos = 0
+        self._capacity = 0
+        self._mmap = None
+        self._grow(max(self.INITIAL_CAPACITY, mmap.PAGESIZE))
+
+    def _grow(self, capacity):
+        # mmap.resize() is not supported on all platforms (e.g. macOS), so
+        # we grow the underlying file and map it anew instead
+        if self._mmap is not None:
+            self._mmap.close()
+        os.ftruncate(self._fd, capacity)
+        self._mmap = mmap.mmap(self._fd, capacity)
+        self._capacity = capacity
+
+    def write(self, s):
+        data = s.encode()
+        end = self._pos + len(data)
+        if end > self._capacity:
+            self._grow(max(end, 2 * self._capacity))
+        self._mmap[self._pos:end] = data
+        self._pos = end
+        return len(s)
+
+    def close(self):
+        if self._mmap.closed:
+            return
+        self._mmap.close()
+        os.ftruncate(self._fd, self._pos)
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cached_emit(output, key, producer, sources=()):
+    """Emit a file, reusing a previously generated copy when possible.
+
+    If the `SNITCH_DATAGEN_CACHE` environment variable points to a
+    directory, generated files are stored in it, indexed by a hash of
+    `key` and of the contents of the `sources` files. Subsequent calls
+    with the same key, and unmodified sources, copy the cached file to
+    `output` instead of invoking `producer`. If the environment variable
+    is not set, `producer` is always invoked.
+
+    Only use this function for deterministic producers, i.e. producers
+    which use a fixed seed to generate random data.
+
+    Args:
+        output: Path of the file to emit.
+        key: A JSON-serializable object identifying the file contents,
+            e.g. the data generation parameters.
+        producer: Function writing the file contents to the file-like
+            object it is passed as only argument.
+        sources: Paths to the files implementing `producer`, whose
+            contents are hashed together with `key`. This module is
+            always implicitly included.
+    """
+    cache_dir = os.environ.get(DATAGEN_CACHE_ENV_VAR)
+    if not cache_dir:
+        with MmapWriter(output) as f:
+            producer(f)
+        return
+
+    digests = [_file_digest(source) for source in [__file__, *sources]]
+    key_str = json.dumps({'key': key, 'sources': digests}, sort_keys=True)
+    cached = pathlib.Path(cache_dir) / f'{hashlib.sha256(key_str.encode()).hexdigest()}.h'
+    if not cached.exists():
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        # Generate to a temporary file and rename it atomically, in case
+        # multiple processes attempt to populate the same cache entry
+        tmp = cached.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            with MmapWriter(tmp) as f:
+                producer(f)
+            os.replace(tmp, cached)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    shutil.copyfile(cached, output)
+
+
 class DataGen:
     """Base data generator class.
 
     Base data generator class which can be inherited to easily develop a
     custom data generator script for any kernel.
+
+    Attributes:
+        CACHEABLE: Whether the generated header can be cached, see
+            `cached_emit()`. Subclasses should only enable this if they
+            generate data deterministically.
     """
 
+    CACHEABLE = False
+
     def parser(self):
         """Default argument parser for data generation scripts.
 
@@ -317,6 +558,12 @@ class DataGen:
             '--section',
             type=str,
             help='Section to store matrices in')
+        if self.CACHEABLE:
+            parser.add_argument(
+                '--no-cache',
+                action='store_true',
+                help=f'Do not use the data generation cache, even if {DATAGEN_CACHE_ENV_VAR} '
+                     'is set')
         parser.add_argument(
             'output',
             type=pathlib.Path,
@@ -343,8 +590,23 @@ class DataGen:
         """
         return emit_license()
 
+    def write_header(self, f, **kwargs):
+        """Writes a C header containing generated data to a file.
+
+        The base implementation writes the string returned by
+        `emit_header()`. Subclasses generating large amounts of data can
+        override this method to stream the header contents to the file
+        instead, e.g. using `emit_array_definition_stream()`.
+
+        Args:
+            f: A file-like object open for writing in text mode.
+        """
+        f.write(self.emit_header(**kwargs))
+
     def main(self):
         """Default main function for data generation scripts."""
+        import json5
+
         args = self.parse_args()
 
         # Load param config file
@@ -353,8 +615,12 @@ class DataGen:
         param['section'] = args.section
 
         # Emit header file
-        with open(args.output, 'w') as f:
-            f.write(self.emit_header(**param))
+        if self.CACHEABLE and not args.no_cache:
+            cached_emit(args.output, param, lambda f: self.write_header(f, **param),
+                        sources=[inspect.getfile(type(self))])
+        else:
+            with MmapWriter(args.output) as f:
+                self.write_header(f, **param)
 
 
 def validate_tcdm_footprint(size, silent=False):
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright 2024 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+from sim.data_utils import cached_emit, MmapWriter, DATAGEN_CACHE_ENV_VAR
+
+KEY = {'size': 16, 'section': None}
+
+
+class Producer:
+
+    def __init__(self, contents='int data[16];\n'):
+        self.contents = contents
+        self.calls = 0
+
+    def __call__(self, f):
+        self.calls += 1
+        f.write(self.contents)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv(DATAGEN_CACHE_ENV_VAR, str(cache_dir))
+    return cache_dir
+
+
+def test_cached_emit_miss_then_hit(tmp_path, cache_dir):
+    producer = Producer()
+    first = tmp_path / 'first.h'
+    second = tmp_path / 'second.h'
+    cached_emit(first, KEY, producer)
+    cached_emit(second, KEY, producer)
+    assert producer.calls == 1
+    assert first.read_text() == producer.contents
+    assert second.read_text() == producer.contents
+
+
+def test_cached_emit_without_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv(DATAGEN_CACHE_ENV_VAR, raising=False)
+    producer = Producer()
+    output = tmp_path / 'data.h'
+    cached_emit(output, KEY, producer)
+    cached_emit(output, KEY, producer)
+    assert producer.calls == 2
+    assert output.read_text() == producer.contents
+
+
+def test_cached_emit_failing_producer(tmp_path, cache_dir):
+    def producer(f):
+        f.write('int data')
+        raise RuntimeError('golden model failed')
+
+    with pytest.raises(RuntimeError):
+        cached_emit(tmp_path / 'data.h', KEY, producer)
+    assert list(cache_dir.iterdir()) == []
+
+    # A later successful run must not be served a partial entry
+    output = tmp_path / 'data.h'
+    cached_emit(output, KEY, Producer())
+    assert output.read_text() == Producer().contents
+
+
+def test_cached_emit_source_change_invalidates(tmp_path, cache_dir):
+    source = tmp_path / 'datagen.py'
+    source.write_text('SEED = 42\n')
+    output = tmp_path / 'data.h'
+    cached_emit(output, KEY, Producer('int a;\n'), sources=[source])
+
+    source.write_text('SEED = 43\n')
+    producer = Producer('int b;\n')
+    cached_emit(output, KEY, producer, sources=[source])
+    assert producer.calls == 1
+    assert output.read_text() == 'int b;\n'
+
+
+def test_mmap_writer_growth(tmp_path, monkeypatch):
+    monkeypatch.setattr(MmapWriter, 'INITIAL_CAPACITY', 1)
+    lines = [f'{i:08x}\n' for i in range(4096)]
+    output = tmp_path / 'data.h'
+    with MmapWriter(output) as f:
+        for line in lines:
+            assert f.write(line) == len(line)
+    assert output.read_text() == ''.join(lines)
+
+
+def test_mmap_writer_truncates(tmp_path):
+    output = tmp_path / 'data.h'
+    with MmapWriter(output) as f:
+        f.write('int data[1];\n')
+    assert output.stat().st_size == len('int data[1];\n')